@@ -0,0 +1,133 @@
+import time
+from itertools import groupby
+from operator import itemgetter
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+
+from modellogger.models import ChangeLog, TrackableModel, TrackableQuerySet, compare_to_log
+from modellogger.sinks import DatabaseSink
+from modellogger.utils import UNSET, pk_ranges, map_in_processes
+
+LATEST_LOGGED_VALUES_SQL = """
+SELECT lmc.object_id, lmc.column_name, lmc.new_value
+FROM (
+    SELECT MAX(id) AS most_recent_id
+    FROM log_model_change
+    WHERE content_type_id = %s AND object_id >= %s AND object_id < %s
+    GROUP BY object_id, column_name
+    ) a
+INNER JOIN log_model_change lmc ON lmc.id = a.most_recent_id
+ORDER BY lmc.object_id
+"""
+
+
+def latest_logged_values(content_type, start, stop, fetch_size=1000):
+    """Stream (object_id, column_name, new_value) of the most recent ChangeLog rows in a pk range, ordered by object_id"""
+    with connections[router.db_for_read(ChangeLog)].cursor() as cursor:
+        cursor.execute(LATEST_LOGGED_VALUES_SQL, [content_type.pk, start, stop])
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+def audit_range(args):
+    """
+    Compare the objects in one pk range to their most recent ChangeLog values
+
+    Both sides are streamed in pk order and merge joined, so memory use doesn't depend on the size of the range.
+    To repair, the range is locked with select_for_update until the repair rows are inserted, so no save can log a
+    change in between, and objects that were never logged get initial state rows like the backfill writes.
+    Returns (start, stop, objects, unlogged objects, [(pk, column, log_version, obj_version), ...]).
+    """
+    model_label, using, start, stop, repair = args
+    model = apps.get_model(model_label)
+    content_type = ContentType.objects.get_for_model(model)
+    objects = TrackableQuerySet(model, using=using).filter(pk__gte=start, pk__lt=stop).order_by('pk').readonly()
+
+    object_count = unlogged_count = 0
+    mismatches = []
+    baselines = []
+    with transaction.atomic(using=using), transaction.atomic(using=router.db_for_write(ChangeLog)):
+        if repair:
+            list(objects.select_for_update().values_list('pk', flat=True))
+        logged_objects = groupby(latest_logged_values(content_type, start, stop), itemgetter(0))
+
+        object_id, logged_rows = next(logged_objects, (None, None))
+        for obj in objects.iterator():
+            object_count += 1
+            # skip the log of objects that are no longer in the table
+            while object_id is not None and object_id < obj.pk:
+                object_id, logged_rows = next(logged_objects, (None, None))
+            if object_id != obj.pk:
+                unlogged_count += 1
+                if repair:
+                    baselines.extend(
+                        ChangeLog(content_type=content_type, object_id=obj.pk, column_name=column_name, old_value=UNSET, new_value=value)
+                        for column_name, value in obj._as_dict().items() if column_name != 'id'
+                    )
+                continue
+
+            logged_data = {column_name: new_value for _, column_name, new_value in logged_rows}
+            for column_name, (log_version, obj_version) in compare_to_log(logged_data, obj._as_dict()).items():
+                mismatches.append((obj.pk, column_name, log_version, obj_version))
+
+        if repair:
+            ChangeLog.objects.bulk_create(baselines + [
+                ChangeLog(content_type=content_type, object_id=pk, column_name=column_name, old_value=log_version, new_value=obj_version)
+                for pk, column_name, log_version, obj_version in mismatches
+            ])
+    return start, stop, object_count, unlogged_count, mismatches
+
+
+class Command(BaseCommand):
+    help = (
+        'Checks that every object of a model matches the most recent values in the ChangeLog, the whole table version '
+        'of TrackableModel.find_unlogged_changes. Exits with an error if there are unlogged changes, unless --repair '
+        'logs them. --repair also logs the initial state of objects that were never logged.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='app_label.ModelName')
+        parser.add_argument('--processes', type=int, default=1, help='Number of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Size of the primary key range handled per task')
+        parser.add_argument('--repair', action='store_true', default=False, help='Log the unlogged changes and never logged objects that are found')
+        parser.add_argument('--database', default=None, help='Database to read the model from')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(model, TrackableModel):
+            raise CommandError('%s is not a TrackableModel' % options['model'])
+        if not isinstance(model.CHANGELOG_SINK, DatabaseSink):
+            raise CommandError('%s does not log to the database' % options['model'])
+
+        using = options['database'] or router.db_for_read(model)
+        tasks = [(model._meta.label, using, start, stop, options['repair'])
+                 for start, stop in pk_ranges(model._base_manager.using(using), options['chunk_size'])]
+
+        total_objects = total_unlogged = total_mismatched = total_columns = 0
+        started = time.time()
+        for i, (start, stop, object_count, unlogged_count, mismatches) in enumerate(map_in_processes(audit_range, tasks, options['processes']), 1):
+            total_objects += object_count
+            total_unlogged += unlogged_count
+            total_mismatched += len({pk for pk, _, _, _ in mismatches})
+            total_columns += len(mismatches)
+            if options['verbosity'] >= 2:
+                for pk, column_name, log_version, obj_version in mismatches:
+                    self.stdout.write('%s %s %s: logged %s, table has %s' % (model._meta.label, pk, column_name, log_version, obj_version))
+            if options['verbosity'] >= 1:
+                self.stdout.write('[%i/%i] pks %i-%i: %i objects, %i columns with unlogged changes (%.0f objects/s)' % (
+                    i, len(tasks), start, stop - 1, object_count, len(mismatches), total_objects / max(time.time() - started, 0.001)))
+
+        self.stdout.write('Checked %i objects in %.1fs: %i with unlogged changes in %i columns, %i never logged%s' % (
+            total_objects, time.time() - started, total_mismatched, total_columns, total_unlogged, ' (repaired)' if options['repair'] else ''))
+        if total_columns and not options['repair']:
+            raise CommandError('%i %s objects have unlogged changes' % (total_mismatched, model._meta.label))
@@ -0,0 +1,104 @@
+import os
+import time
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+
+from modellogger.models import ChangeLog, TrackableModel, TrackableQuerySet
+from modellogger.sinks import DatabaseSink
+from modellogger.utils import UNSET, pk_ranges, map_in_processes
+
+
+def backfill_range(args):
+    """
+    Write the initial state ChangeLog rows for the objects in one pk range, returns (start, stop, objects, rows)
+
+    The range is locked with select_for_update until the rows are inserted. A save to it waits, so its change is logged
+    after the baseline rather than before a stale one.
+    """
+    model_label, using, start, stop, batch_size = args
+    model = apps.get_model(model_label)
+    content_type = ContentType.objects.get_for_model(model)
+    objects = TrackableQuerySet(model, using=using).filter(pk__gte=start, pk__lt=stop).order_by('pk').readonly()
+
+    object_count = row_count = 0
+    with transaction.atomic(using=using), transaction.atomic(using=router.db_for_write(ChangeLog)):
+        list(objects.select_for_update().values_list('pk', flat=True))
+        # columns logged by saves since TRACK_CHANGES was turned on (or by an earlier run) already have a baseline
+        logged = set(
+            ChangeLog.objects.filter(content_type=content_type, object_id__gte=start, object_id__lt=stop)
+            .values_list('object_id', 'column_name').distinct()
+        )
+
+        changelog_objects = []
+        for obj in objects.iterator():
+            object_count += 1
+            for column_name, value in obj._as_dict().items():
+                if column_name == 'id' or (obj.pk, column_name) in logged:
+                    continue
+                changelog_objects.append(ChangeLog(content_type=content_type, object_id=obj.pk, column_name=column_name, old_value=UNSET, new_value=value))
+            if len(changelog_objects) >= batch_size:
+                ChangeLog.objects.bulk_create(changelog_objects)
+                row_count += len(changelog_objects)
+                changelog_objects = []
+        ChangeLog.objects.bulk_create(changelog_objects)
+        row_count += len(changelog_objects)
+    return start, stop, object_count, row_count
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes initial state ChangeLog rows for the existing objects of a model, so that turning on TRACK_CHANGES for '
+        'a populated table leaves find_unlogged_changes with nothing to report. Columns that already have a ChangeLog '
+        'row are skipped, which makes the command safe to rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='app_label.ModelName')
+        parser.add_argument('--processes', type=int, default=1, help='Number of worker processes, needs a database that allows concurrent writers (not sqlite)')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Size of the primary key range handled per task')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows held in memory before they are inserted')
+        parser.add_argument('--progress-file', help='Records finished pk ranges, ranges listed in it are skipped on the next run')
+        parser.add_argument('--database', default=None, help='Database to read the model from')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(model, TrackableModel):
+            raise CommandError('%s is not a TrackableModel' % options['model'])
+        if not isinstance(model.CHANGELOG_SINK, DatabaseSink):
+            raise CommandError('%s does not log to the database' % options['model'])
+
+        using = options['database'] or router.db_for_read(model)
+        ranges = pk_ranges(model._base_manager.using(using), options['chunk_size'])
+
+        progress_file = options['progress_file']
+        finished = set()
+        if progress_file and os.path.exists(progress_file):
+            with open(progress_file) as f:
+                finished = {tuple(int(n) for n in line.split()) for line in f if line.strip()}
+        tasks = [(model._meta.label, using, start, stop, options['batch_size']) for start, stop in ranges if (start, stop) not in finished]
+        self.stdout.write('Backfilling %s: %i of %i pk ranges to do' % (model._meta.label, len(tasks), len(ranges)))
+
+        total_objects = total_rows = 0
+        started = time.time()
+        progress = open(progress_file, 'a') if progress_file else None
+        try:
+            for i, (start, stop, object_count, row_count) in enumerate(map_in_processes(backfill_range, tasks, options['processes']), 1):
+                if progress:
+                    progress.write('%i %i\n' % (start, stop))
+                    progress.flush()
+                total_objects += object_count
+                total_rows += row_count
+                elapsed = max(time.time() - started, 0.001)
+                self.stdout.write('[%i/%i] pks %i-%i: %i objects, %i rows (%.0f objects/s, %.0f rows/s)' % (
+                    i, len(tasks), start, stop - 1, object_count, row_count, total_objects / elapsed, total_rows / elapsed))
+        finally:
+            if progress:
+                progress.close()
+
+        self.stdout.write('Wrote %i ChangeLog rows for %i objects in %.1fs' % (total_rows, total_objects, time.time() - started))
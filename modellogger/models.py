@@ -1,16 +1,46 @@
 from __future__ import absolute_import
 
+import threading
+from contextlib import contextmanager
+from operator import attrgetter, itemgetter
+
 from django.db import models
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import fields
-from django.db import router, connections
+from django.db import router, connections, transaction
 from django.db.models.fields import FieldDoesNotExist
-from django.db.models.signals import post_save
+from django.db.models.fields.related import lazy_related_operation
+from django.db.models.query import ModelIterable
+from django.db.models.signals import class_prepared, m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import Signal
-from modellogger.utils import dict_diff, UNSET, xstr, content_type_dict
+from modellogger.utils import dict_diff, UNSET, xstr, content_type_dict, tuple_getter, logged_text
 
 from .middleware import get_request
+from .sinks import DatabaseSink
+
+
+# tells TrackableModel.__init__ how the instance being constructed was loaded
+_loading = threading.local()
+
+# ChangeLog rows held back by batch_change_logs
+_batch = threading.local()
+
+# (model, pk) of the parent rows deleted along with a tracked multi-table inheritance child
+_deleted_parents = threading.local()
+
+# the many to many fields whose memberships are logged
+_tracked_m2m_fields = set()
+
+
+class ReadOnlyInstanceError(Exception):
+    """Raised when an instance loaded with readonly() is saved or checked for changes"""
+
+
+def refuse_readonly_save(sender, instance, **kwargs):
+    """Read-only instances never took an initial snapshot so there is nothing to diff a save against"""
+    if instance._readonly:
+        raise ReadOnlyInstanceError('%s instance was loaded with readonly() and cannot be saved' % sender.__name__)
 
 
 def mark_from_db(sender, instance, **kwargs):
@@ -23,6 +53,47 @@ def save_initial_model_state(sender, instance, **kwargs):
     instance.save_initial_state()
 
 
+@contextmanager
+def batch_change_logs(using=None):
+    """
+    Hold back the ChangeLog rows written inside the block and hand them to their sinks in one batch at the end
+
+    The outermost block runs in a transaction on the `using` database, so if the block raises, the saves made in it
+    are rolled back along with their unwritten rows. Blocks can be nested, the outermost one writes the rows.
+    """
+    if getattr(_batch, 'changelogs', None) is not None:
+        yield
+        return
+
+    # {sink: [changelog, ...]}
+    _batch.changelogs = changelogs = {}
+    try:
+        with transaction.atomic(using=using):
+            yield
+            _batch.changelogs = None
+            for sink, changelog_objects in changelogs.items():
+                sink.write(changelog_objects)
+    finally:
+        _batch.changelogs = None
+
+
+def write_change_logs(sink, changelog_objects):
+    """Write ChangeLog rows to a sink, or hold them back until the end of the enclosing batch_change_logs block"""
+    changelogs = getattr(_batch, 'changelogs', None)
+    if changelogs is not None:
+        changelogs.setdefault(sink, []).extend(changelog_objects)
+    elif changelog_objects:
+        sink.write(changelog_objects)
+
+
+def new_changelog(request, **kwargs):
+    """A ChangeLog attributed to the user making the request"""
+    changelog = ChangeLog(**kwargs)
+    if request and request.user and request.user.id:
+        changelog.user_id = request.user.id
+    return changelog
+
+
 def save_model_changes(sender, instance, **kwargs):
     """Save a log of dirty model changes and reset the model to clean"""
     changes = instance._changes_pending_no_check_db
@@ -31,20 +102,184 @@ def save_model_changes(sender, instance, **kwargs):
     for column_name, (old_value, new_value) in changes.items():
         if column_name == 'id':
             continue
-        changelog = ChangeLog(content_object=instance, column_name=column_name, old_value=old_value, new_value=new_value)
-        if request and request.user and request.user.id:
-            changelog.user_id = request.user.id
-        changelog_objects.append(changelog)
+        changelog_objects.append(new_changelog(request, content_object=instance, column_name=column_name, old_value=old_value, new_value=new_value))
 
-    ChangeLog.objects.bulk_create(changelog_objects)
+    write_change_logs(instance.CHANGELOG_SINK, changelog_objects)
     instance.save_initial_state()
     if changes:
         model_changes_saved.send(sender=sender, instance=instance, changes=changes)
 
 
+def tracked_parents(model):
+    """The TRACK_CHANGES models a model inherits from with multi-table inheritance"""
+    return [parent for parent in model._meta.concrete_model._meta.get_parent_list()
+            if issubclass(parent, TrackableModel) and getattr(parent, 'TRACK_CHANGES', False)]
+
+
+def mark_deleted_parents(sender, instance, **kwargs):
+    """
+    Remember the parent rows that are deleted with a multi-table inheritance child
+
+    The child's log already has every field it inherits, so the parent instances skip theirs. Django sends all the
+    pre_delete signals of a delete before the first post_delete.
+    """
+    if getattr(_deleted_parents, 'keys', None) is None:
+        _deleted_parents.keys = set()
+    _deleted_parents.keys.update((parent, instance.pk) for parent in tracked_parents(sender))
+
+
+def save_model_deletion(sender, instance, **kwargs):
+    """Save a log of the final state of a deleted model, every column changes to UNSET"""
+    key = (sender._meta.concrete_model, instance.pk)
+    if key in (getattr(_deleted_parents, 'keys', None) or ()):
+        _deleted_parents.keys.discard(key)
+        return
+
+    request = get_request()
+    changelog_objects = [
+        new_changelog(request, content_object=instance, column_name=column_name, old_value=old_value, new_value=UNSET)
+        for column_name, old_value in instance._as_dict().items() if column_name != 'id'
+    ]
+    for column_name, member_ids in getattr(instance, '_deleted_memberships', {}).items():
+        changelog_objects.extend(
+            new_changelog(request, content_object=instance, column_name=column_name, old_value=member_id, new_value=UNSET)
+            for member_id in member_ids
+        )
+    write_change_logs(instance.CHANGELOG_SINK, changelog_objects)
+
+
+def remember_deleted_memberships(sender, instance, **kwargs):
+    """
+    Look up the many to many members of an object that is about to be deleted
+
+    The delete removes the through rows with a plain DELETE that sends no m2m_changed, so save_model_deletion logs
+    them with the rest of the final state.
+    """
+    instance._deleted_memberships = {
+        field.name: list(field.remote_field.through._default_manager.filter(**{field.m2m_field_name(): instance.pk})
+                         .values_list(field.m2m_reverse_field_name(), flat=True))
+        for field in sender._meta.many_to_many if field in _tracked_m2m_fields
+    }
+
+
+def save_deleted_members(sender, instance, **kwargs):
+    """Save a log of the memberships removed from tracked objects by deleting the object they point to"""
+    request = get_request()
+    # {sink: [changelog, ...]} so that the fields of a sink are written together
+    changelogs = {}
+    for field in _tracked_m2m_fields:
+        if field.remote_field.model is not sender:
+            continue
+        object_ids = (field.remote_field.through._default_manager.filter(**{field.m2m_reverse_field_name(): instance.pk})
+                      .values_list(field.m2m_field_name(), flat=True))
+        content_type = ContentType.objects.get_for_model(field.model)
+        changelogs.setdefault(field.model.CHANGELOG_SINK, []).extend(
+            new_changelog(request, content_type=content_type, object_id=object_id, column_name=field.name, old_value=instance.pk, new_value=UNSET)
+            for object_id in object_ids
+        )
+    for sink, changelog_objects in changelogs.items():
+        write_change_logs(sink, changelog_objects)
+
+
+def save_m2m_changes(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Save a log of many to many membership changes
+
+    Each added member is logged as a change from UNSET to its pk and each removed member as a change from its pk to
+    UNSET, against the object of the model that declares the field.
+    """
+    if action not in ('post_add', 'pre_remove', 'pre_clear'):
+        return
+
+    # the object with the field is `instance` for forward changes and the pk_set objects for reverse ones
+    tracked_model = model if reverse else instance.__class__
+    field = next(f for f in tracked_model._meta.many_to_many if f.remote_field.through is sender)
+    if action != 'post_add':
+        # remove's pk_set has every pk it was given, members or not, and clear provides none, so find out what is about
+        # to be removed
+        instance_field_name, pk_field_name = field.m2m_field_name(), field.m2m_reverse_field_name()
+        if reverse:
+            instance_field_name, pk_field_name = pk_field_name, instance_field_name
+        members = sender._default_manager.filter(**{instance_field_name: instance.pk})
+        if action == 'pre_remove':
+            members = members.filter(**{pk_field_name + '__in': pk_set})
+        pk_set = members.values_list(pk_field_name, flat=True)
+
+    if reverse:
+        object_ids = [(pk, instance.pk) for pk in pk_set]
+    else:
+        object_ids = [(instance.pk, pk) for pk in pk_set]
+
+    request = get_request()
+    content_type = ContentType.objects.get_for_model(tracked_model)
+    changelog_objects = []
+    for object_id, member_id in object_ids:
+        if action == 'post_add':
+            old_value, new_value = UNSET, member_id
+        else:
+            old_value, new_value = member_id, UNSET
+        changelog_objects.append(new_changelog(request, content_type=content_type, object_id=object_id, column_name=field.name, old_value=old_value, new_value=new_value))
+    write_change_logs(tracked_model.CHANGELOG_SINK, changelog_objects)
+
+
 model_changes_saved = Signal(providing_args=["instance", "changes"])
 
 
+def compare_to_log(logged_data, current_data):
+    """
+    Which columns differ from the most recent value logged for them, as {column: (log_version, obj_version)}
+
+    Values are compared as the text the ChangeLog stores them as. Logged columns that no longer exist are ignored.
+    """
+    unlogged_changes = {}
+    for column_name, log_version in logged_data.items():
+        obj_version = current_data.get(column_name, UNSET)
+        if obj_version is not UNSET and log_version != logged_text(obj_version):
+            unlogged_changes[column_name] = (log_version, obj_version)
+    return unlogged_changes
+
+
+class ReadOnlyModelIterable(ModelIterable):
+    """Yields model instances that skip the initial state snapshot"""
+
+    def __iter__(self):
+        objects = super(ReadOnlyModelIterable, self).__iter__()
+        while True:
+            # only flag the construction of our own rows, the caller's loop body runs between yields
+            _loading.readonly = True
+            try:
+                obj = next(objects)
+            except StopIteration:
+                return
+            finally:
+                _loading.readonly = False
+            yield obj
+
+
+class TrackableQuerySet(models.QuerySet):
+    """QuerySet for TrackableModels"""
+
+    def readonly(self):
+        """
+        Load instances without snapshotting their initial state
+
+        Useful for list views and reports that never save. The instances raise ReadOnlyInstanceError if saved.
+        """
+        clone = self._clone()
+        clone._iterable_class = ReadOnlyModelIterable
+        return clone
+
+    def delete(self):
+        """Delete the objects, saving the ChangeLog rows of the whole cascade with a single insert"""
+        with batch_change_logs(using=self._db or router.db_for_write(self.model, **self._hints)):
+            return super(TrackableQuerySet, self).delete()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+TrackableManager = models.Manager.from_queryset(TrackableQuerySet)
+
+
 class ChangeLog(models.Model):
     """Used to record field-level changes to models"""
     timestamp = models.DateTimeField(auto_now=True)
@@ -90,14 +325,56 @@ class ChangeLog(models.Model):
 
 class TrackableModel(models.Model):
     EXCLUDED_TRACKING_FIELDS = ['created_on', 'updated_on', 'id']
+    # build the initial state of instances loaded from the database from the raw row, only once it is needed
+    LAZY_INITIAL_STATE = False
+    # where the ChangeLog rows go, see modellogger.sinks
+    CHANGELOG_SINK = DatabaseSink()
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
+    objects = TrackableManager()
+
+    # class level defaults so that the common case doesn't store these on every instance
+    _readonly = False
+    _snapshot_pending = False
+
     def __init__(self, *args, **kwargs):
         super(TrackableModel, self).__init__(*args, **kwargs)
         self.__class__.class_setup()
         self._from_db = self.pk is not None
-        self.save_initial_state()
+        if getattr(_loading, 'readonly', False):
+            self._readonly = True
+        elif getattr(_loading, 'lazy', False):
+            self._snapshot_pending = True
+        else:
+            self.save_initial_state()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        cls.class_setup()
+        if not cls._lazy_initial_state or cls._deferred:
+            return super(TrackableModel, cls).from_db(db, field_names, values)
+
+        _loading.lazy = True
+        try:
+            new = super(TrackableModel, cls).from_db(db, field_names, values)
+        finally:
+            _loading.lazy = False
+        # the row is exactly what __init__ was given, so it doubles as the initial state until that is needed
+        if new._snapshot_pending:
+            new._db_values = values
+        return new
+
+    def delete(self, using=None, keep_parents=False):
+        """Delete the object, saving the ChangeLog rows of the whole cascade with a single insert"""
+        using = using or router.db_for_write(self.__class__, instance=self)
+        pk = self.pk
+        with batch_change_logs(using=using):
+            deleted = super(TrackableModel, self).delete(using=using, keep_parents=keep_parents)
+        if keep_parents and getattr(_deleted_parents, 'keys', None):
+            # the parents weren't deleted, so nothing claimed what mark_deleted_parents recorded for them
+            _deleted_parents.keys.difference_update((parent, pk) for parent in tracked_parents(self.__class__))
+        return deleted
 
     @classmethod
     def class_setup(cls):
@@ -119,6 +396,14 @@ class TrackableModel(models.Model):
                 # Which fields do we not track
                 cls._excluded_tracking_fields = getattr(cls, 'EXCLUDED_TRACKING_FIELDS', []) + TrackableModel.EXCLUDED_TRACKING_FIELDS
                 cls._fields_minus_exclusions = [f for f in cls._meta.fields if f.attname not in cls._excluded_tracking_fields]
+                # the original state is stored as a tuple in the order of _fields_minus_exclusions
+                cls._get_tracked_values = staticmethod(tuple_getter(attrgetter, [f.attname for f in cls._fields_minus_exclusions]))
+
+            # from_db rows are ordered like the concrete fields
+            concrete_positions = {f.attname: i for i, f in enumerate(cls._meta.concrete_fields)}
+            cls._lazy_initial_state = cls.LAZY_INITIAL_STATE and all(f.attname in concrete_positions for f in cls._fields_minus_exclusions)
+            if cls._lazy_initial_state:
+                cls._get_db_tracked_values = staticmethod(tuple_getter(itemgetter, [concrete_positions[f.attname] for f in cls._fields_minus_exclusions]))
 
             # what action is taken after each save?
             post_save_method = save_initial_model_state
@@ -130,21 +415,12 @@ class TrackableModel(models.Model):
 
             post_save.connect(post_save_method, sender=cls, dispatch_uid='DirtyRecord-%s' % cls.__name__)
             post_save.connect(mark_from_db, sender=cls, dispatch_uid='MarkFromDb-%s' % cls.__name__)
+            pre_save.connect(refuse_readonly_save, sender=cls, dispatch_uid='RefuseReadOnly-%s' % cls.__name__)
 
     def _empty_dict(self):
         """An empty dict version of the model"""
         return {f.attname: UNSET for f in self._fields_minus_exclusions}
 
-    def _as_dict_no_prep(self):
-        """The model's state as a dictionary (without passing through prep value)
-
-        This is an optimization over using _as_dict for cases where the object is unlikely to be modified.
-        For example if we're creating 1000 objects for display only.  Calling get_prep_value across 1000 objects x # of fields
-        actually adds up to a lot of cpu time. Because we don't call get_prep_value here, we call it when the _original_state value is used in
-        _original_state_no_check_db
-        """
-        return {f.attname: getattr(self, f.attname) for f in self._fields_minus_exclusions}
-
     def _as_dict(self):
         """Converts the model to a dictionary in a way conducive to logging"""
         return {f.attname: f.get_prep_value(getattr(self, f.attname)) for f in self._fields_minus_exclusions}
@@ -154,15 +430,36 @@ class TrackableModel(models.Model):
         Set the model to a clean state
 
         This is called after the model is initialized or saved
+
+        The state is stored as a tuple of the raw attribute values, aligned with _fields_minus_exclusions. A tuple takes
+        a fraction of the memory of a dict per instance. get_prep_value is deliberately not called here: for objects that
+        are only displayed (for example 1000 objects in a list view) calling it across objects x fields adds up to a lot
+        of cpu time, so it's only called on the values that are actually compared in _changes_pending_no_check_db.
         """
-        self._original_state = self._as_dict_no_prep()
+        self._original_state = self._get_tracked_values(self)
+        self._discard_db_values()
+
+    def _discard_db_values(self):
+        """Drop the raw row kept by LAZY_INITIAL_STATE"""
+        if self._snapshot_pending:
+            del self._snapshot_pending
+            del self._db_values
+
+    def _original_values(self):
+        """The raw original state tuple"""
+        if self._readonly:
+            raise ReadOnlyInstanceError('%s instance was loaded with readonly() and has no initial state' % self.__class__.__name__)
+        if self._snapshot_pending:
+            self._original_state = self._get_db_tracked_values(self._db_values)
+            self._discard_db_values()
+        return self._original_state
 
     @property
     def _original_state_no_check_db(self):
         """When called from the post_save signal we want the original state"""
         if not self._from_db:
             return self._empty_dict()
-        return {f.attname: f.get_prep_value(self._original_state[f.attname]) for f in self._fields_minus_exclusions}
+        return {f.attname: f.get_prep_value(value) for f, value in zip(self._fields_minus_exclusions, self._original_values())}
 
     @property
     def dirty_fields(self):
@@ -182,7 +479,18 @@ class TrackableModel(models.Model):
     @property
     def _changes_pending_no_check_db(self):
         """Which fields are dirty and what changes are being made to them?"""
-        return dict_diff(self._original_state_no_check_db, self._as_dict())
+        if not self._from_db:
+            return dict_diff(self._empty_dict(), self._as_dict())
+
+        changes = {}
+        for f, old_value, new_value in zip(self._fields_minus_exclusions, self._original_values(), self._get_tracked_values(self)):
+            # an unchanged field still holds the very same object, which spares us the get_prep_value calls
+            if old_value is new_value:
+                continue
+            old_value, new_value = f.get_prep_value(old_value), f.get_prep_value(new_value)
+            if old_value != new_value:
+                changes[f.attname] = (old_value, new_value)
+        return changes
 
     def find_unlogged_changes(self):
         """Compares the current object to the most recent values stored in the ChangeLog"""
@@ -206,14 +514,42 @@ class TrackableModel(models.Model):
             cursor.execute(sql)
             rows = cursor.fetchall()
         logged_data = {n: v for n, v in rows}
-        changes = dict_diff(logged_data, self._as_dict())
-        unlogged_changes = {}
-        for col_name, (log_version, obj_version) in changes.items():
-            if obj_version != UNSET:
-                unlogged_changes[col_name] = (log_version, obj_version)
-
-        return unlogged_changes
+        return compare_to_log(logged_data, self._as_dict())
 
     class Meta(object):
         """Object metaclass"""
         abstract = True
+
+
+def connect_m2m_tracking(model, through, target, field):
+    """Log membership changes of a many to many field once its through and target models are registered"""
+    _tracked_m2m_fields.add(field)
+    # connect by through model so that fields inherited by subclasses are only logged once
+    m2m_changed.connect(save_m2m_changes, sender=through, dispatch_uid='M2MChanges-%s' % through._meta.label)
+    pre_delete.connect(remember_deleted_memberships, sender=model, dispatch_uid='DeletedMemberships-%s' % model.__name__)
+    pre_delete.connect(save_deleted_members, sender=target, dispatch_uid='DeletedMembers-%s' % target._meta.label)
+
+
+def connect_change_tracking(sender, **kwargs):
+    """
+    Log deletes and many to many changes of TRACK_CHANGES models
+
+    Unlike saves, these can reach a model that was never instantiated: deletes cascade, and reverse many to many
+    managers and deletes of the target model change memberships by pk. Django "fast deletes" models without delete
+    signal receivers with a plain DELETE, so the receivers are connected as soon as the class exists instead of in
+    class_setup.
+    """
+    if not (issubclass(sender, TrackableModel) and getattr(sender, 'TRACK_CHANGES', False)):
+        return
+    post_delete.connect(save_model_deletion, sender=sender, dispatch_uid='DeletedRecord-%s' % sender.__name__)
+    if tracked_parents(sender):
+        pre_delete.connect(mark_deleted_parents, sender=sender, dispatch_uid='DeletedParents-%s' % sender.__name__)
+
+    excluded_fields = getattr(sender, 'EXCLUDED_TRACKING_FIELDS', []) + TrackableModel.EXCLUDED_TRACKING_FIELDS
+    for f in sender._meta.many_to_many:
+        if f.name not in excluded_fields:
+            # the through and target models may still be string references that are resolved once their app is loaded
+            lazy_related_operation(connect_m2m_tracking, sender, f.remote_field.through, f.remote_field.model, field=f)
+
+
+class_prepared.connect(connect_change_tracking)
@@ -0,0 +1,152 @@
+"""
+Destinations for ChangeLog rows
+
+A TrackableModel writes its ChangeLog rows to its CHANGELOG_SINK:
+
+    class Customer(TrackableModel):
+        TRACK_CHANGES = True
+        CHANGELOG_SINK = FileSink('/var/log/audit/customer')
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+
+from modellogger.utils import logged_text
+
+
+class ChangeLogSink(object):
+    """Base class for ChangeLog destinations"""
+
+    def write(self, changelogs):
+        """Store a batch of unsaved ChangeLog objects"""
+        raise NotImplementedError
+
+
+class DatabaseSink(ChangeLogSink):
+    """Saves the rows to the log_model_change table"""
+
+    def write(self, changelogs):
+        from modellogger.models import ChangeLog
+        ChangeLog.objects.bulk_create(changelogs)
+
+
+class MemorySink(ChangeLogSink):
+    """Keeps the rows in a list, for tests"""
+
+    def __init__(self):
+        self.changelogs = []
+
+    def write(self, changelogs):
+        self.changelogs.extend(changelogs)
+
+    def clear(self):
+        self.changelogs = []
+
+
+class FileSink(ChangeLogSink):
+    """
+    Appends the rows as JSON lines to segment files in a directory
+
+    Each sink writes to its own segments in each process, so several sinks can share a directory. A new segment is
+    started once the current one reaches segment_size bytes.
+    Rows written inside a transaction on the `using` database are only appended once it commits, and are dropped if it
+    rolls back, like the rows of a DatabaseSink. Rows reach the operating system as they are appended but are only
+    fsync'ed once fsync_every rows have accumulated, or by the first append at least fsync_interval seconds after the
+    last fsync. There is no timer, so the interval is only checked on the next append: the rows of a burst followed by
+    silence stay unsynced until the next append, sync() or close(), and a machine crash can lose them. Call sync() to
+    fsync immediately.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync_every=1000, fsync_interval=1.0, using=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.using = using
+        self._lock = threading.Lock()
+        # tells apart the segments of sinks sharing a directory in one process
+        self._token = uuid.uuid4().hex[:8]
+        self._file = None
+        self._pid = None
+        self._segment_number = 0
+        self._unsynced_rows = 0
+        self._last_sync = time.time()
+        atexit.register(self.close)
+
+    def write(self, changelogs):
+        if not changelogs:
+            return
+        timestamp = timezone.now().isoformat()
+        data = ''.join(json.dumps(self._as_json(changelog, timestamp), sort_keys=True) + '\n' for changelog in changelogs).encode('utf-8')
+        # outside of a transaction on_commit appends right away
+        transaction.on_commit(lambda: self._append(data, len(changelogs)), using=self.using)
+
+    def sync(self):
+        """fsync the rows written so far"""
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._close_segment()
+
+    def _append(self, data, row_count):
+        with self._lock:
+            segment = self._segment()
+            segment.write(data)
+            segment.flush()
+            self._unsynced_rows += row_count
+            if self._unsynced_rows >= self.fsync_every or time.time() - self._last_sync >= self.fsync_interval:
+                self._sync()
+            if segment.tell() >= self.segment_size:
+                self._close_segment()
+
+    def _as_json(self, changelog, timestamp):
+        content_type = ContentType.objects.get_for_id(changelog.content_type_id)
+        return {
+            'timestamp': timestamp,
+            'user_id': changelog.user_id,
+            'content_type_id': changelog.content_type_id,
+            'model': '%s.%s' % (content_type.app_label, content_type.model),
+            'object_id': changelog.object_id,
+            'column_name': changelog.column_name,
+            'old_value': logged_text(changelog.old_value),
+            'new_value': logged_text(changelog.new_value),
+        }
+
+    def _segment(self):
+        """The open segment file of this process"""
+        if self._pid != os.getpid():
+            # a forked child inherits the parent's file object, never write to the parent's segment
+            self._file = None
+            self._pid = os.getpid()
+            self._segment_number = 0
+        if self._file is None:
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+            self._segment_number += 1
+            name = 'changelog-%s-%i-%s-%06i.jsonl' % (time.strftime('%Y%m%d%H%M%S'), self._pid, self._token, self._segment_number)
+            self._file = open(os.path.join(self.directory, name), 'ab')
+        return self._file
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced_rows = 0
+        self._last_sync = time.time()
+
+    def _close_segment(self):
+        self._sync()
+        self._file.close()
+        self._file = None
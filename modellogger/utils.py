@@ -1,4 +1,10 @@
+import multiprocessing
+
+import django
 from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils.encoding import force_text
 
 
 class UnsetValue(object):
@@ -23,6 +29,52 @@ def content_type_dict():
     return _CONTENT_TYPES_DICT
 
 
+def logged_text(value):
+    """The text a value is stored as in ChangeLog.old_value and ChangeLog.new_value"""
+    return None if value is None else force_text(value)
+
+
+def tuple_getter(getter, keys):
+    """operator.attrgetter or itemgetter for keys that always returns a tuple, even for zero or one key"""
+    if not keys:
+        return lambda obj: ()
+    if len(keys) == 1:
+        get = getter(keys[0])
+        return lambda obj: (get(obj),)
+    return getter(*keys)
+
+
 def dict_diff(old, new):
     """Return the difference between the two dicts"""
     return {key: (value, new.get(key, UNSET)) for key, value in old.items() if value != new.get(key, UNSET)}
+
+
+def pk_ranges(queryset, chunk_size):
+    """
+    Split the primary keys of a queryset into [start, stop) ranges
+
+    The ranges are aligned to multiples of chunk_size so that they stay the same between runs.
+    """
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    first = bounds['low'] // chunk_size * chunk_size
+    return [(start, start + chunk_size) for start in range(first, bounds['high'] + 1, chunk_size)]
+
+
+def map_in_processes(func, args_list, processes):
+    """Yield func(args) for each args in a process pool, in completion order. A single process runs in this one."""
+    if processes <= 1:
+        for args in args_list:
+            yield func(args)
+        return
+
+    # forked workers must not share the database connections of this process
+    connections.close_all()
+    pool = multiprocessing.Pool(processes, initializer=django.setup)
+    try:
+        for result in pool.imap_unordered(func, args_list):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
@@ -10,7 +10,7 @@ setup(
     description=("Change tracking for Django models."),
     keywords="django",
     url="http://packages.python.org/django-modellogger",
-    packages=['modellogger', 'modellogger.migrations'],
+    packages=['modellogger', 'modellogger.migrations', 'modellogger.management', 'modellogger.management.commands'],
     long_description="""Tracks changes to django models.""",
     classifiers=[
         "Development Status :: 3 - Alpha",
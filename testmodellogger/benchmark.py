@@ -0,0 +1,197 @@
+"""
+Rough benchmarks for the modellogger hot paths
+
+Runs against a throwaway test database:
+
+    $ python benchmark.py snapshot --rows 100000
+    $ python benchmark.py state --rows 100000
+    $ python benchmark.py load --threads 16 --requests 200 --rounds 10
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testmodellogger.settings")
+
+import django  # noqa
+django.setup()
+
+from django.conf import settings  # noqa
+from django.db import connection  # noqa
+from django.core.handlers.wsgi import WSGIHandler  # noqa
+from django.test import RequestFactory  # noqa
+from django.test.utils import setup_test_environment  # noqa
+from modellogger import middleware  # noqa
+from testapp.models import Person, LazyPerson, WideModel  # noqa
+
+
+def timed(label, func, repeat=3):
+    """Print the best of `repeat` runs"""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    print('%-30s %.3fs' % (label, min(timings)))
+
+
+def create_people(rows):
+    Person.objects.bulk_create(Person(first_name='Bob', last_name=str(i), donuts_consumed=i) for i in range(rows))
+
+
+def bench_snapshot(args):
+    """Iterating over a large queryset with and without the initial state snapshot"""
+    create_people(args.rows)
+
+    def iterate(queryset):
+        return lambda: [p.first_name for p in queryset.iterator()]
+
+    timed('eager snapshot', iterate(Person.objects.all()))
+    timed('LAZY_INITIAL_STATE', iterate(LazyPerson.objects.all()))
+    timed('readonly()', iterate(Person.objects.readonly()))
+
+
+def bench_state(args):
+    """Memory used by the original state of a wide model, and the time to check it for changes"""
+    objects = [WideModel(id=i, name='Company %i' % i, employees=i, city='San Francisco') for i in range(args.rows)]
+    for obj in objects:
+        # keep the attribute (and so the instance __dict__ layout) but release the state
+        obj._original_state = None
+
+    tracemalloc.start()
+    for obj in objects:
+        obj.save_initial_state()
+    state_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%-30s %.1f bytes/instance' % ('original state', state_size / float(args.rows)))
+
+    timed('is_dirty (clean)', lambda: [obj.is_dirty for obj in objects])
+    for obj in objects:
+        obj.city = 'Oakland'
+    timed('is_dirty (one change)', lambda: [obj.is_dirty for obj in objects])
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def load_round(handler, threads, requests_per_thread):
+    """
+    Request the tracked and untracked save views from concurrent threads, returns (latencies, errors, seconds)
+
+    The requests go straight to the WSGI handler like a threaded WSGI server would send them. Django's test Client
+    reconnects a signal receiver on every request, which leaks a weakref.finalize each time on python 3.
+    """
+    factory = RequestFactory()
+    latencies = {'tracked': [], 'untracked': []}
+    errors = []
+    lock = threading.Lock()
+
+    def client_thread():
+        thread_latencies = {'tracked': [], 'untracked': []}
+        for i in range(requests_per_thread):
+            kind = 'tracked' if i % 2 else 'untracked'
+            environ = factory.get('/save/%s/' % kind).environ
+            status = []
+            start = time.time()
+            response = handler(environ, lambda status_line, headers: status.append(status_line))
+            try:
+                content = b''.join(response)
+            finally:
+                response.close()
+            thread_latencies[kind].append(time.time() - start)
+            if not status[0].startswith('200'):
+                errors.append('%s %s: %s' % (kind, status[0], content[:200]))
+        with lock:
+            for kind, values in thread_latencies.items():
+                latencies[kind].extend(values)
+
+    start = time.time()
+    workers = [threading.Thread(target=client_thread) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors, time.time() - start
+
+
+def bench_load(args):
+    """
+    Concurrent requests through GlobalRequestMiddleware and tracked saves, checking for leaks
+
+    The first round is timed, the following ones run under tracemalloc and fail the benchmark if GlobalRequestMiddleware
+    holds on to requests or memory keeps growing.
+    """
+    setup_test_environment()
+    settings.DEBUG = False
+    handler = WSGIHandler()
+
+    latencies, errors, seconds = load_round(handler, args.threads, args.requests)
+    total = sum(len(values) for values in latencies.values())
+    print('%-30s %.0f requests/s' % ('%i threads' % args.threads, total / seconds))
+    for kind in sorted(kind for kind, values in latencies.items() if values):
+        print('%-30s p50 %.1fms  p99 %.1fms' % (kind + ' save', percentile(latencies[kind], 50) * 1000, percentile(latencies[kind], 99) * 1000))
+
+    tracemalloc.start()
+    load_round(handler, args.threads, args.requests)
+    # requests leave reference cycles behind, only count what survives a collection
+    gc.collect()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i in range(2, args.rounds):
+        _, round_errors, _ = load_round(handler, args.threads, args.requests)
+        errors.extend(round_errors)
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - baseline
+        print('%-30s %+.1fKB traced memory, %i requests held' % ('round %i' % (i + 1), growth / 1024.0, len(middleware._requests)))
+    tracemalloc.stop()
+
+    failures = errors[:10]
+    if middleware._requests:
+        failures.append('GlobalRequestMiddleware still holds %i requests' % len(middleware._requests))
+    if args.rounds > 2 and growth > args.max_growth_kb * 1024:
+        failures.append('traced memory grew by %.1fKB' % (growth / 1024.0))
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+BENCHMARKS = {
+    'snapshot': bench_snapshot,
+    'state': bench_state,
+    'load': bench_load,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per thread and round')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--max-growth-kb', type=int, default=256)
+    args = parser.parse_args()
+    if args.requests < 2:
+        parser.error('--requests must be at least 2, the requests alternate between the untracked and tracked views')
+
+    # a file rather than an in-memory database, so that concurrent connections wait on each other's locks
+    test_dir = tempfile.mkdtemp()
+    settings.DATABASES['default']['TEST'] = {'NAME': os.path.join(test_dir, 'benchmark.sqlite3')}
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        BENCHMARKS[args.benchmark](args)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(test_dir)
+
+
+if __name__ == '__main__':
+    main()
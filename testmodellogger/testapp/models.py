@@ -2,9 +2,18 @@ from django.db import models
 from modellogger.models import TrackableModel
 
 
+class Tag(models.Model):
+    name = models.CharField(max_length=40, default='')
+
+
 class TrackedModel(TrackableModel):
     TRACK_CHANGES = True
     ordinal = models.PositiveIntegerField(null=True, default=None)
+    tags = models.ManyToManyField(Tag, related_name='tracked_models')
+
+
+class UntrackedModel(TrackableModel):
+    ordinal = models.PositiveIntegerField(null=True, default=None)
 
 
 class Person(TrackableModel):
@@ -24,3 +33,34 @@ class UserProfile(Person):
     identity_verification_user = models.ForeignKey('UserProfile', null=True, related_name="+")
     account_balance = models.FloatField(null=True, default=None)
     date_joined = models.DateTimeField(null=True, default=None)
+
+
+class WideModel(TrackableModel):
+    TRACK_CHANGES = True
+    name = models.CharField(max_length=100, default='')
+    description = models.TextField(default='')
+    address_1 = models.CharField(max_length=100, default='')
+    address_2 = models.CharField(max_length=100, default='')
+    city = models.CharField(max_length=100, default='')
+    state = models.CharField(max_length=2, default='')
+    postal_code = models.CharField(max_length=10, default='')
+    country = models.CharField(max_length=2, default='US')
+    phone = models.CharField(max_length=20, default='')
+    email = models.EmailField(default='')
+    website = models.URLField(default='')
+    employees = models.PositiveIntegerField(null=True, default=None)
+    revenue = models.FloatField(null=True, default=None)
+    founded = models.DateField(null=True, default=None)
+    is_public = models.BooleanField(default=False)
+    rating = models.IntegerField(default=0)
+    owner = models.ForeignKey(Person, null=True)
+    notes = models.TextField(default='')
+    industry = models.CharField(max_length=100, default='')
+    ticker = models.CharField(max_length=10, default='')
+
+
+class LazyPerson(Person):
+    LAZY_INITIAL_STATE = True
+
+    class Meta(object):
+        proxy = True
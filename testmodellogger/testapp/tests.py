@@ -1,11 +1,25 @@
+from operator import itemgetter
+
+import json
+import threading
+
 import pytest
 from django import forms
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-
-from modellogger.models import ChangeLog, TrackableModel
-from modellogger.utils import UNSET
-from testapp.models import UserProfile, TrackedModel, Person
+from django.core.management import call_command, CommandError
+from django.db import connection, models, transaction
+from django.db.models.signals import m2m_changed
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from modellogger.models import ChangeLog, TrackableModel, ReadOnlyInstanceError, batch_change_logs, connect_change_tracking
+from modellogger import middleware
+from modellogger.middleware import GlobalRequestMiddleware, get_request
+from modellogger.sinks import FileSink, MemorySink
+from modellogger.utils import UNSET, tuple_getter
+from testapp.models import UserProfile, TrackedModel, Person, LazyPerson, WideModel, Tag
 
 pytestmark = pytest.mark.django_db
 
@@ -262,6 +276,17 @@ def test_find_unlogged_changes():
     assert unlogged_data['first_name'] == ('Samantha', 'Sam')
 
 
+def test_find_unlogged_changes_compares_logged_text():
+    p = Person(first_name="Bob", donuts_consumed=5)
+    p.save()
+
+    assert p.find_unlogged_changes() == {}
+
+    Person.objects.all().update(donuts_consumed=6)
+    p = Person.objects.get(pk=p.pk)
+    assert p.find_unlogged_changes() == {'donuts_consumed': ('5', 6)}
+
+
 def test_find_unlogged_changes_with_column_change():
     p = Person(first_name="Bob")
     p.save()
@@ -270,3 +295,413 @@ def test_find_unlogged_changes_with_column_change():
     unlogged_data = p.find_unlogged_changes()
 
     assert len(unlogged_data) == 0
+
+
+def test_readonly_skips_initial_state():
+    Person(first_name="Bob").save()
+
+    p = Person.objects.readonly().get(first_name="Bob")
+    assert p.first_name == 'Bob'
+    assert '_original_state' not in p.__dict__
+
+    with pytest.raises(ReadOnlyInstanceError):
+        p.is_dirty
+
+    p.first_name = 'Sally'
+    with pytest.raises(ReadOnlyInstanceError):
+        p.save()
+    assert Person.objects.get(pk=p.pk).first_name == 'Bob'
+
+
+def test_readonly_only_affects_queryset_rows():
+    Person(first_name="Bob").save()
+
+    for p in Person.objects.filter(first_name="Bob").readonly():
+        assert p._readonly
+        new_person = Person(first_name="Sally")
+        new_person.save()
+        assert not new_person._readonly
+
+    assert not Person.objects.get(first_name="Bob")._readonly
+
+
+def test_readonly_inherited_by_subclasses():
+    UserProfile(first_name="Bob").save()
+
+    assert UserProfile.objects.readonly()[0]._readonly
+
+
+def test_lazy_initial_state():
+    Person(first_name="Bob").save()
+    changelog_count = ChangeLog.objects.count()
+
+    p = LazyPerson.objects.get(first_name="Bob")
+    assert '_original_state' not in p.__dict__
+    assert not p.is_dirty
+
+    p = LazyPerson.objects.get(first_name="Bob")
+    p.first_name = 'Sally'
+    assert p.changes_pending == {'first_name': ('Bob', 'Sally')}
+    p.save()
+    assert not p.is_dirty
+    assert ChangeLog.objects.count() == changelog_count + 1
+
+    # readonly instances keep neither the snapshot nor the row it would be built from
+    p = LazyPerson.objects.readonly().get(first_name="Sally")
+    assert '_original_state' not in p.__dict__
+    assert '_db_values' not in p.__dict__
+
+
+def test_lazy_initial_state_with_relationships():
+    boss = Person(first_name="Boss")
+    boss.save()
+    Person(first_name="Bob").save()
+
+    p = LazyPerson.objects.get(first_name="Bob")
+    p.investor_executive = boss
+    assert p.changes_pending == {'investor_executive_id': (None, boss.pk)}
+
+
+def test_tuple_getter():
+    values = ['a', 'b', 'c']
+    assert tuple_getter(itemgetter, [])(values) == ()
+    assert tuple_getter(itemgetter, [1])(values) == ('b',)
+    assert tuple_getter(itemgetter, [2, 0])(values) == ('c', 'a')
+
+
+def test_original_state_is_aligned_to_tracked_fields():
+    company = WideModel(name='Acme', city='Springfield')
+    company.save()
+
+    company = WideModel.objects.get(pk=company.pk)
+    assert isinstance(company._original_state, tuple)
+    assert len(company._original_state) == len(WideModel._fields_minus_exclusions)
+
+    company.city = 'Shelbyville'
+    company.employees = 10
+    assert company.changes_pending == {'city': ('Springfield', 'Shelbyville'), 'employees': (None, 10)}
+
+
+def changelog_inserts(queries):
+    return [q for q in queries if q['sql'].startswith('INSERT INTO "log_model_change"')]
+
+
+def test_track_delete():
+    p = Person(first_name='Bob')
+    p.save()
+    pk = p.pk
+    ChangeLog.objects.all().delete()
+
+    p.delete()
+    logs = ChangeLog.objects.filter(object_id=pk)
+    assert len(logs) == NUMBER_OF_TRACKED_PERSON_FIELDS
+    first_name_log = logs.get(column_name='first_name')
+    assert first_name_log.old_value == 'Bob'
+    assert first_name_log.new_value == repr(UNSET)
+
+
+def test_track_delete_cascade_in_one_insert():
+    boss = Person(first_name='Boss')
+    boss.save()
+    for name in ['Bob', 'Sally', 'Sam']:
+        Person(first_name=name, investor_executive=boss).save()
+    ChangeLog.objects.all().delete()
+
+    with CaptureQueriesContext(connection) as queries:
+        Person.objects.filter(pk=boss.pk).delete()
+
+    assert Person.objects.count() == 0
+    assert len(changelog_inserts(queries)) == 1
+    assert ChangeLog.objects.count() == 4 * NUMBER_OF_TRACKED_PERSON_FIELDS
+    assert set(ChangeLog.objects.filter(column_name='first_name').values_list('old_value', flat=True)) == {'Boss', 'Bob', 'Sally', 'Sam'}
+
+
+def test_track_multi_table_inheritance_delete():
+    NUMBER_OF_TRACKED_USER_PROFILE_FIELDS = len(UserProfile._meta.fields) - 4  # also person_ptr
+    profiles = [UserProfile(first_name='Bob'), UserProfile(first_name='Sally')]
+    for profile in profiles:
+        profile.save()
+    ChangeLog.objects.all().delete()
+
+    profiles[0].delete()
+    Person.objects.filter(pk=profiles[1].pk).delete()
+
+    userprofile_type = ContentType.objects.get_for_model(UserProfile)
+    assert ChangeLog.objects.count() == 2 * NUMBER_OF_TRACKED_USER_PROFILE_FIELDS
+    assert set(ChangeLog.objects.values_list('content_type_id', flat=True)) == {userprofile_type.pk}
+
+    # keep_parents leaves a Person whose own delete is logged later
+    profile = UserProfile(first_name='Sam')
+    profile.save()
+    profile.delete(keep_parents=True)
+    ChangeLog.objects.all().delete()
+    Person.objects.get(first_name='Sam').delete()
+    assert ChangeLog.objects.count() == NUMBER_OF_TRACKED_PERSON_FIELDS
+
+
+def test_batch_change_logs():
+    with CaptureQueriesContext(connection) as queries:
+        with batch_change_logs():
+            for i in range(3):
+                TrackedModel(ordinal=i).save()
+            assert ChangeLog.objects.count() == 0
+
+    assert len(changelog_inserts(queries)) == 1
+    assert ChangeLog.objects.count() == 3
+
+
+def test_batch_change_logs_rolls_back_saves_when_it_raises():
+    with pytest.raises(ZeroDivisionError):
+        with batch_change_logs():
+            for i in range(3):
+                TrackedModel(ordinal=i).save()
+            1 / 0
+
+    assert TrackedModel.objects.count() == 0
+    assert ChangeLog.objects.count() == 0
+
+
+def test_track_m2m_changes():
+    tm = TrackedModel()
+    tm.save()
+    tags = [Tag.objects.create(name=str(i)) for i in range(3)]
+    ChangeLog.objects.all().delete()
+
+    with CaptureQueriesContext(connection) as queries:
+        tm.tags.add(*tags)
+    assert len(changelog_inserts(queries)) == 1
+    logs = ChangeLog.objects.filter(column_name='tags', object_id=tm.pk)
+    assert {(log.old_value, log.new_value) for log in logs} == {(repr(UNSET), str(tag.pk)) for tag in tags}
+
+    tm.tags.remove(tags[0])
+    assert ChangeLog.objects.filter(column_name='tags', old_value=str(tags[0].pk), new_value=repr(UNSET)).count() == 1
+    # removing what isn't a member changes nothing
+    tm.tags.remove(tags[0], Tag.objects.create(name='not a member'))
+    assert ChangeLog.objects.filter(column_name='tags', new_value=repr(UNSET)).count() == 1
+
+    tm.tags.clear()
+    assert ChangeLog.objects.filter(column_name='tags', new_value=repr(UNSET)).count() == 3
+
+
+def test_track_reverse_m2m_changes():
+    tms = [TrackedModel(), TrackedModel()]
+    for tm in tms:
+        tm.save()
+    tag = Tag.objects.create(name='red')
+    ChangeLog.objects.all().delete()
+
+    tag.tracked_models.add(*tms)
+    logs = ChangeLog.objects.filter(column_name='tags')
+    assert {(log.object_id, log.new_value) for log in logs} == {(tm.pk, str(tag.pk)) for tm in tms}
+
+    tag.tracked_models.clear()
+    assert ChangeLog.objects.filter(column_name='tags', old_value=str(tag.pk), new_value=repr(UNSET)).count() == 2
+
+
+def test_track_reverse_m2m_changes_before_tracked_model_is_instantiated(monkeypatch):
+    TrackedModel.objects.bulk_create([TrackedModel(), TrackedModel()])
+    pks = list(TrackedModel.objects.values_list('pk', flat=True))
+    tag = Tag.objects.create(name='red')
+    # put TrackedModel back into the state of a freshly imported class, as class_prepared left it
+    monkeypatch.delattr(TrackedModel, '_trackable_model_initialized')
+    m2m_changed.disconnect(sender=TrackedModel.tags.through, dispatch_uid='M2MChanges-testapp.TrackedModel_tags')
+    connect_change_tracking(TrackedModel)
+
+    tag.tracked_models.add(*pks)
+    assert {(log.object_id, log.new_value) for log in ChangeLog.objects.filter(column_name='tags')} == {(pk, str(tag.pk)) for pk in pks}
+    tag.tracked_models.clear()
+    assert ChangeLog.objects.filter(column_name='tags', old_value=str(tag.pk), new_value=repr(UNSET)).count() == 2
+    assert '_trackable_model_initialized' not in TrackedModel.__dict__
+
+
+def test_track_m2m_memberships_removed_by_delete():
+    tms = [TrackedModel(), TrackedModel()]
+    for tm in tms:
+        tm.save()
+    tags = [Tag.objects.create(name=str(i)) for i in range(3)]
+    for tm in tms:
+        tm.tags.add(*tags)
+    ChangeLog.objects.all().delete()
+
+    tag_pk = tags[0].pk
+    tags[0].delete()
+    logs = ChangeLog.objects.filter(column_name='tags')
+    assert {(log.object_id, log.old_value, log.new_value) for log in logs} == {(tm.pk, str(tag_pk), repr(UNSET)) for tm in tms}
+
+    ChangeLog.objects.all().delete()
+    tm_pk = tms[0].pk
+    tms[0].delete()
+    logs = ChangeLog.objects.filter(column_name='tags')
+    assert {(log.object_id, log.old_value) for log in logs} == {(tm_pk, str(tag.pk)) for tag in tags[1:]}
+    assert ChangeLog.objects.filter(column_name='ordinal').count() == 1
+
+
+def test_batch_delete_from_untrackable_model():
+    tms = [TrackedModel(), TrackedModel()]
+    for tm in tms:
+        tm.save()
+    tags = [Tag.objects.create(name=str(i)) for i in range(5)]
+    for tm in tms:
+        tm.tags.add(*tags)
+    ChangeLog.objects.all().delete()
+
+    # Tag isn't a TrackableModel, so its deletes are only batched by an enclosing block
+    with CaptureQueriesContext(connection) as queries:
+        with batch_change_logs():
+            Tag.objects.all().delete()
+
+    assert len(changelog_inserts(queries)) == 1
+    assert ChangeLog.objects.filter(column_name='tags', new_value=repr(UNSET)).count() == 2 * 5
+
+
+def test_backfill_command(tmpdir):
+    Person.objects.bulk_create(Person(first_name=str(i)) for i in range(25))
+    assert ChangeLog.objects.count() == 0
+    p = Person.objects.get(first_name='3')
+    p.first_name = 'Sally'
+    p.save()
+
+    progress_file = str(tmpdir.join('progress'))
+    with CaptureQueriesContext(connection) as queries:
+        call_command('modellogger_backfill', 'testapp.Person', chunk_size=10, batch_size=20, progress_file=progress_file, stdout=StringIO())
+
+    assert ChangeLog.objects.count() == 25 * NUMBER_OF_TRACKED_PERSON_FIELDS
+    # the rows of each range are inserted in slices of batch_size rows
+    assert len(changelog_inserts(queries)) > 3
+    for person in Person.objects.all():
+        assert person.find_unlogged_changes() == {}
+    assert len(open(progress_file).readlines()) == 3
+
+    # finished ranges are skipped and already logged columns are never logged twice
+    out = StringIO()
+    call_command('modellogger_backfill', 'testapp.Person', chunk_size=10, progress_file=progress_file, stdout=out)
+    assert '0 of 3 pk ranges' in out.getvalue()
+    call_command('modellogger_backfill', 'testapp.Person', chunk_size=7, stdout=StringIO())
+    assert ChangeLog.objects.count() == 25 * NUMBER_OF_TRACKED_PERSON_FIELDS
+
+
+def test_audit_command():
+    people = [Person(first_name=str(i), donuts_consumed=i) for i in range(25)]
+    for person in people:
+        person.save()
+    Person.objects.bulk_create([Person(first_name='never logged')])
+    call_command('modellogger_audit', 'testapp.Person', chunk_size=10, stdout=StringIO())
+
+    # make untracked changes
+    Person.objects.filter(pk__in=[people[3].pk, people[17].pk]).update(first_name='Sam')
+    Person.objects.filter(pk=people[3].pk).update(donuts_consumed=100)
+    out = StringIO()
+    with pytest.raises(CommandError, match='2 testapp.Person objects have unlogged changes'):
+        call_command('modellogger_audit', 'testapp.Person', chunk_size=10, verbosity=2, stdout=out)
+    assert "%s first_name: logged 3, table has Sam" % people[3].pk in out.getvalue()
+    assert '2 with unlogged changes in 3 columns, 1 never logged' in out.getvalue()
+
+    call_command('modellogger_audit', 'testapp.Person', chunk_size=10, repair=True, stdout=StringIO())
+    out = StringIO()
+    call_command('modellogger_audit', 'testapp.Person', chunk_size=10, stdout=out)
+    assert '0 with unlogged changes in 0 columns, 0 never logged' in out.getvalue()
+    assert Person.objects.get(pk=people[3].pk).find_unlogged_changes() == {}
+
+
+def test_memory_sink(monkeypatch):
+    sink = MemorySink()
+    monkeypatch.setattr(TrackedModel, 'CHANGELOG_SINK', sink)
+
+    tm = TrackedModel(ordinal=1)
+    tm.save()
+    with batch_change_logs():
+        tm.ordinal = 2
+        tm.save()
+        Person().save()
+        assert len(sink.changelogs) == 1
+
+    assert [(log.old_value, log.new_value) for log in sink.changelogs] == [(UNSET, 1), (1, 2)]
+    assert ChangeLog.objects.count() == NUMBER_OF_TRACKED_PERSON_FIELDS
+
+
+@pytest.mark.django_db(transaction=True)
+def test_file_sink(tmpdir, monkeypatch):
+    sink = FileSink(str(tmpdir), segment_size=400, fsync_every=2)
+    monkeypatch.setattr(TrackedModel, 'CHANGELOG_SINK', sink)
+
+    tm = TrackedModel(ordinal=1)
+    tm.save()
+    for ordinal in range(2, 6):
+        tm.ordinal = ordinal
+        tm.save()
+    sink.close()
+
+    assert ChangeLog.objects.count() == 0
+    segments = sorted(tmpdir.listdir())
+    assert len(segments) > 1
+    rows = [json.loads(line) for segment in segments for line in segment.readlines()]
+    assert [(row['old_value'], row['new_value']) for row in rows] == [
+        (repr(UNSET), '1'), ('1', '2'), ('2', '3'), ('3', '4'), ('4', '5')
+    ]
+    assert rows[0]['model'] == 'testapp.trackedmodel'
+    assert rows[0]['object_id'] == tm.pk
+    assert rows[0]['column_name'] == 'ordinal'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_file_sink_follows_transactions(tmpdir, monkeypatch):
+    sink = FileSink(str(tmpdir))
+    monkeypatch.setattr(TrackedModel, 'CHANGELOG_SINK', sink)
+
+    with transaction.atomic():
+        TrackedModel(ordinal=1).save()
+        transaction.set_rollback(True)
+    assert tmpdir.listdir() == []
+
+    with transaction.atomic():
+        TrackedModel(ordinal=2).save()
+        assert tmpdir.listdir() == []
+    sink.close()
+    rows = [json.loads(line) for segment in tmpdir.listdir() for line in segment.readlines()]
+    assert [row['new_value'] for row in rows] == ['2']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_file_sinks_sharing_a_directory(tmpdir, monkeypatch):
+    monkeypatch.setattr(TrackedModel, 'CHANGELOG_SINK', FileSink(str(tmpdir)))
+    monkeypatch.setattr(Person, 'CHANGELOG_SINK', FileSink(str(tmpdir)))
+
+    TrackedModel(ordinal=1).save()
+    Person(first_name='Bob').save()
+    TrackedModel.CHANGELOG_SINK.close()
+    Person.CHANGELOG_SINK.close()
+
+    segments = tmpdir.listdir()
+    assert len(segments) == 2
+    assert sorted(len(segment.readlines()) for segment in segments) == [1, NUMBER_OF_TRACKED_PERSON_FIELDS]
+
+
+def test_middleware_concurrent_requests():
+    factory = RequestFactory()
+    global_request_middleware = GlobalRequestMiddleware()
+    errors = []
+
+    def handle_requests():
+        for _ in range(200):
+            request = factory.get('/')
+            global_request_middleware.process_request(request)
+            if get_request() is not request:
+                errors.append('get_request() returned the request of another thread')
+            global_request_middleware.process_response(request, HttpResponse())
+
+    threads = [threading.Thread(target=handle_requests) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert middleware._requests == {}
+
+
+def test_tracked_save_through_middleware(client):
+    response = client.get('/save/tracked/')
+
+    assert response.status_code == 200
+    assert ChangeLog.objects.filter(object_id=int(response.content)).count() == 2
+    assert middleware._requests == {}
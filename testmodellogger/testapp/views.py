@@ -0,0 +1,21 @@
+from django.http import HttpResponse, HttpResponseServerError
+
+from modellogger.middleware import get_request
+from testapp.models import TrackedModel, UntrackedModel
+
+MODELS = {
+    'tracked': TrackedModel,
+    'untracked': UntrackedModel,
+}
+
+
+def save_model(request, model_name):
+    """Create an object and update it, used by the load harness in benchmark.py"""
+    if get_request() is not request:
+        return HttpResponseServerError('get_request() returned the request of another thread')
+
+    obj = MODELS[model_name](ordinal=1)
+    obj.save()
+    obj.ordinal = 2
+    obj.save()
+    return HttpResponse(str(obj.pk))
@@ -96,6 +96,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'modellogger.middleware.GlobalRequestMiddleware',
 )
 
 ROOT_URLCONF = 'testmodellogger.urls'
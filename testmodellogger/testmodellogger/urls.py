@@ -1,3 +1,7 @@
-from django.conf.urls import patterns
+from django.conf.urls import url
 
-urlpatterns = patterns('',)
+from testapp import views
+
+urlpatterns = [
+    url(r'^save/(?P<model_name>tracked|untracked)/$', views.save_model),
+]